@@ -19,27 +19,120 @@
 
 import os
 import logging
+import threading
+import time
 import jsonpatch
+from concurrent.futures import ThreadPoolExecutor, wait
 from copy import deepcopy
+from uuid import uuid4
 
 from flask import Flask, request, make_response
+import fastjsonschema
 import mimeparse
+from pymongo.errors import PyMongoError
 
 from lib.database import DatabaseController
-from lib.keyrock_client import KeyrockClient, KeyrockError
+from lib.keyrock_client import KeyrockError
 from lib.umbrella_client import UmbrellaClient, UmbrellaError
-from lib.utils import authorized, build_response, consumes, URLify
-from settings import (IDM_URL, IDM_PASSWD, IDM_USER, IDM_USER_ID, BROKER_APP_ID,
+from lib.utils import (authorized, build_conditional_response, build_response, consumes, get_keyrock_client,
+                       io_pool, OrjsonProvider, URLify, CACHE_MAX_AGE)
+from settings import (IDM_USER_ID, BROKER_APP_ID,
                       BAE_APP_ID, BROKER_ADMIN_ROLE, BROKER_CONSUMER_ROLE, BAE_SELLER_ROLE,
                       BAE_CUSTOMER_ROLE, BAE_ADMIN_ROLE, UMBRELLA_URL, UMBRELLA_TOKEN, UMBRELLA_KEY,
-                      MONGO_HOST, MONGO_PORT)
+                      MONGO_HOST, MONGO_PORT, MONGO_MAX_POOL_SIZE)
 
 
+_DEBUG = os.environ.get("DEBUG", "false").strip().lower() == "true"
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+app.json.sort_keys = False
 app.url_map.strict_slashes = False
 
+_log = app.logger
+
+# Schema of the tenant creation requests, compiled once into a validator
+_TENANT_SCHEMA = {
+    "type": "object",
+    "required": ["name", "description"],
+    "properties": {
+        "name": {"type": "string", "minLength": 1},
+        "description": {"type": "string"},
+        "users": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "required": ["name", "roles"],
+                "properties": {
+                    "id": {"type": "string"},
+                    "name": {"type": "string"},
+                    "roles": {
+                        "type": "array",
+                        "items": {"type": "string"}
+                    }
+                }
+            }
+        }
+    }
+}
+_validate_tenant = fastjsonschema.compile(_TENANT_SCHEMA)
+
+# Process wide clients, created on first use so that every gunicorn
+# worker owns its MongoDB and HTTP connection pools. The Keyrock client
+# is shared with the authorization decorator (see lib.utils)
+_database_controller = None
+_database_lock = threading.Lock()
+
+_umbrella_client = None
+_umbrella_lock = threading.Lock()
+
+# Attempts made to store a tenant whose organization and policies are already created
+_COMPLETE_ATTEMPTS = 3
+_COMPLETE_RETRY_DELAY = 0.5
+
+# Pool running the tenant creations requested asynchronously. It is separated
+# from the IO pool since the jobs wait on requests submitted to that pool
+_job_pool = ThreadPoolExecutor(max_workers=4)
+
+
+def _get_database_controller():
+    global _database_controller
+
+    if _database_controller is None:
+        with _database_lock:
+            if _database_controller is None:
+                _database_controller = DatabaseController(
+                    host=MONGO_HOST, port=MONGO_PORT, max_pool_size=MONGO_MAX_POOL_SIZE)
+
+    return _database_controller
+
+
+def _get_umbrella_client():
+    global _umbrella_client
+
+    if _umbrella_client is None:
+        with _umbrella_lock:
+            if _umbrella_client is None:
+                _umbrella_client = UmbrellaClient(UMBRELLA_URL, UMBRELLA_TOKEN, UMBRELLA_KEY)
+
+    return _umbrella_client
+
+
+def _run_concurrently(calls):
+    """
+    Runs the given (function, args) calls in the IO pool and returns their
+    results in order. All the calls are completed before raising the first
+    error found
+    """
+    futures = [io_pool.submit(func, *args) for func, args in calls]
+    wait(futures)
+
+    return [future.result() for future in futures]
+
 
 def _build_policy(method, tenant, role):
+    # A fresh literal is cheaper than copying a template, and policies must
+    # not share nested objects once merged into the API sub settings
     return {
         "http_method": method,
         "regex": "^/",
@@ -64,18 +157,110 @@ def _create_access_policies(tenant, org_id, user_info):
     admin_role = org_id + '.' + BROKER_ADMIN_ROLE
     admin_policy = _build_policy('any', tenant, admin_role)
 
-    # Add new policies to existing API sub settings
-    umbrella_client = UmbrellaClient(UMBRELLA_URL, UMBRELLA_TOKEN, UMBRELLA_KEY)
-    umbrella_client.add_sub_url_setting_app_id(BROKER_APP_ID, [read_policy, admin_policy])
+    # Add new policies to existing API sub settings, along with the ones
+    # of other tenants being created at the same time
+    umbrella_client = _get_umbrella_client()
+    umbrella_client.queue_sub_url_setting_app_id(BROKER_APP_ID, [read_policy, admin_policy])
+
+
+def _get_user_id(keyrock_client, user):
+    # User names are not used to identify users in Keyrock
+    if 'id' in user:
+        return user['id']
+
+    return keyrock_client.get_user_id(user['name'])
+
 
+def _create_tenant(tenant_id, name, description, tenant_users, user_info):
+    """
+    Creates the organization, roles and access policies of a reserved tenant.
+    The reservation is released if the tenant cannot be created
+    """
+    database_controller = _get_database_controller()
+
+    try:
+        org_id, users = _create_tenant_organization(name, description, tenant_users, user_info)
+        _create_access_policies(tenant_id, org_id, user_info)
+    except Exception:
+        database_controller.delete_tenant(tenant_id)
+        raise
+
+    # The organization and policies already exist, so the reservation is not
+    # released here. Otherwise the TTL index would remove it, leaving both orphaned
+    for attempt in range(1, _COMPLETE_ATTEMPTS + 1):
+        try:
+            database_controller.complete_tenant(tenant_id, users, org_id)
+            break
+        except PyMongoError:
+            if attempt == _COMPLETE_ATTEMPTS:
+                _log.error('Tenant %s was created with organization %s but it could not be stored',
+                           tenant_id, org_id, exc_info=True)
+                raise
+
+            time.sleep(_COMPLETE_RETRY_DELAY)
+
+
+def _create_tenant_organization(name, description, tenant_users, user_info):
+    keyrock_client = get_keyrock_client()
+    org_id = keyrock_client.create_organization(name, description, user_info['id'])
+
+    # Add context broker and BAE roles, and resolve the IDs of the tenant users.
+    # These requests are independent so they are made concurrently
+    authorize_calls = [
+        (keyrock_client.authorize_organization, (org_id, BROKER_APP_ID, BROKER_ADMIN_ROLE, BROKER_CONSUMER_ROLE)),
+        (keyrock_client.authorize_organization_role, (org_id, BAE_APP_ID, BAE_SELLER_ROLE, 'owner')),
+        (keyrock_client.authorize_organization_role, (org_id, BAE_APP_ID, BAE_CUSTOMER_ROLE, 'owner')),
+        (keyrock_client.authorize_organization_role, (org_id, BAE_APP_ID, BAE_ADMIN_ROLE, 'owner'))
+    ]
+
+    user_calls = [(_get_user_id, (keyrock_client, user)) for user in tenant_users]
+
+    user_ids = _run_concurrently(authorize_calls + user_calls)[len(authorize_calls):]
+
+    # Add tenant users if provided
+    users = []
+    grant_calls = []
+    for user, user_id in zip(tenant_users, user_ids):
+        user_obj = {
+            'id': user_id,
+            'name': user['name'],
+            'roles': []
+        }
 
-def _map_roles(member):
-    roles = [BROKER_CONSUMER_ROLE]
+        # Keyrock IDM only supports a single organization role
+        user_obj['roles'].append(BROKER_CONSUMER_ROLE)
+
+        if BROKER_ADMIN_ROLE in user['roles']:
+            grant_calls.append((keyrock_client.grant_organization_role, (org_id, user_id, 'owner')))
+            user_obj['roles'].append(BROKER_ADMIN_ROLE)
+        else:
+            grant_calls.append((keyrock_client.grant_organization_role, (org_id, user_id, 'member')))
+
+        users.append(user_obj)
+
+    _run_concurrently(grant_calls)
+
+    return org_id, users
+
+
+def _run_tenant_job(job_id, tenant_id, name, description, tenant_users, user_info):
+    database_controller = _get_database_controller()
+
+    try:
+        _create_tenant(tenant_id, name, description, tenant_users, user_info)
+    except (KeyrockError, UmbrellaError) as e:
+        database_controller.update_job(job_id, 'failed', error=str(e))
+    except Exception:
+        _log.exception('Unexpected error creating tenant %s', tenant_id)
+        database_controller.update_job(job_id, 'failed', error='Internal server error')
+    else:
+        database_controller.update_job(job_id, 'completed')
 
-    if member['role'] == 'owner':
-        roles.append(BROKER_ADMIN_ROLE)
 
-    return roles
+def _prefers_async():
+    # Clients ask for asynchronous processing with the Prefer header (RFC 7240)
+    preferences = request.headers.get('Prefer', '').split(',')
+    return 'respond-async' in [preference.split(';')[0].strip().lower() for preference in preferences]
 
 
 @app.route("/tenant", methods=['POST'])
@@ -83,94 +268,66 @@ def _map_roles(member):
 @consumes("application/json")
 def create(user_info):
     # Get tenant info for JSON request
-    if 'name' not in request.json:
+    body = request.json
+    try:
+        _validate_tenant(body)
+    except fastjsonschema.JsonSchemaException as e:
         return build_response({
-            'error': 'Missing required field name'
+            'error': str(e)
         }, 422)
 
-    if 'description' not in request.json:
+    name = body['name']
+    description = body['description']
+    users = body.get('users', [])
+
+    options = body.get('options', {})
+    if not isinstance(options, dict):
         return build_response({
-            'error': 'Missing required field description'
+            'error': 'Options field must be an object'
         }, 422)
 
-    if 'users' in request.json:
-        for user in request.json.get('users'):
-            if 'name' not in user or 'roles' not in user:
-                return build_response({
-                    'error': 'Missing required field in user specification'
-                }, 422)
-
-    options = {}
-    if 'options' in request.json:
-        if not isinstance(request.json.get('options'), dict):
-            return build_response({
-                'error': 'Options field must be an object'
-            }, 422)
-
-        options = request.json.get('options')
-
-    tenant_id = None
-    try:
-        # Build tenant-id
-        tenant_id = URLify(request.json.get('name'))
-        if not len(tenant_id):
-            # All the provided characters were invalid
-            return build_response({
-                'error': 'It was not possible to generate a tenant ID as all the characters were invalid'
-            }, 422)
-
-        database_controller = DatabaseController(host=MONGO_HOST, port=MONGO_PORT)
-        prev_t = database_controller.get_tenant(tenant_id)
-
-        if prev_t is not None:
-            return build_response({
-                'error': 'The tenant {} is already registered'.format(tenant_id)
-            }, 409)
-
-        keyrock_client = KeyrockClient(IDM_URL, IDM_USER, IDM_PASSWD)
-        org_id = keyrock_client.create_organization(
-            request.json.get('name'), request.json.get('description'), user_info['id'])
-
-        # Add context broker role
-        keyrock_client.authorize_organization(org_id, BROKER_APP_ID, BROKER_ADMIN_ROLE, BROKER_CONSUMER_ROLE)
-
-        # Add BAE roles
-        keyrock_client.authorize_organization_role(org_id, BAE_APP_ID, BAE_SELLER_ROLE, 'owner')
-        keyrock_client.authorize_organization_role(org_id, BAE_APP_ID, BAE_CUSTOMER_ROLE, 'owner')
-        keyrock_client.authorize_organization_role(org_id, BAE_APP_ID, BAE_ADMIN_ROLE, 'owner')
-
-        # Add tenant users if provided
-        users = []
-        for user in request.json.get('users', []):
-            # User names are not used to identify users in Keyrock
-            if 'id' not in user:
-                user_id = keyrock_client.get_user_id(user['name'])
-            else:
-                user_id = user['id']
-
-            user_obj = {
-                'id': user_id,
-                'name': user['name'],
-                'roles': []
-            }
-
-            # Keyrock IDM only supports a single organization role
-            user_obj['roles'].append(BROKER_CONSUMER_ROLE)
-
-            if BROKER_ADMIN_ROLE in user['roles']:
-                keyrock_client.grant_organization_role(org_id, user_id, 'owner')
-                user_obj['roles'].append(BROKER_ADMIN_ROLE)
-            else:
-                keyrock_client.grant_organization_role(org_id, user_id, 'member')
+    # Build tenant-id
+    tenant_id = URLify(name)
+    if not len(tenant_id):
+        # All the provided characters were invalid
+        return build_response({
+            'error': 'It was not possible to generate a tenant ID as all the characters were invalid'
+        }, 422)
 
-            users.append(user_obj)
+    # The unique tenant ID index makes the reservation fail for duplicated tenants
+    database_controller = _get_database_controller()
+    reserved = database_controller.reserve_tenant(
+        tenant_id, name, description, user_info['id'], options=options)
 
-        _create_access_policies(tenant_id, org_id, user_info)
+    if not reserved:
+        return build_response({
+            'error': 'The tenant {} is already registered'.format(tenant_id)
+        }, 409)
 
-        database_controller.save_tenant(
-            tenant_id, request.json.get('name'), request.json.get('description'), user_info['id'], users, org_id, options=options)
+    if _prefers_async():
+        # Create the tenant in background and return a job the client can poll
+        job_id = uuid4().hex
+        try:
+            database_controller.save_job(job_id, user_info['id'], tenant_id)
+            _job_pool.submit(_run_tenant_job, job_id, tenant_id, name, description, users, user_info)
+        except Exception:
+            # Release the tenant name so the creation can be retried
+            database_controller.delete_tenant(tenant_id)
+            raise
+
+        response = build_response({
+            'id': job_id,
+            'status': 'pending'
+        }, 202)
+        response.headers['Location'] = request.path + '/jobs/' + job_id
+        response.headers['Preference-Applied'] = 'respond-async'
+
+        return response
 
+    try:
+        _create_tenant(tenant_id, name, description, users, user_info)
     except (KeyrockError, UmbrellaError) as e:
+        _log.warning('Error creating tenant %s', tenant_id, exc_info=True)
         return build_response({
             'error': str(e)
         }, 503)
@@ -181,12 +338,26 @@ def create(user_info):
     return response
 
 
+@app.route("/tenant/jobs/<job_id>", methods=['GET'])
+@authorized
+def get_tenant_job(user_info, job_id):
+    database_controller = _get_database_controller()
+    job = database_controller.get_job(job_id)
+
+    if job is None or job['owner_id'] != user_info['id']:
+        return build_response({
+            'error': 'Job {} does not exist'.format(job_id)
+        }, 404)
+
+    return build_response(job, 200)
+
+
 @app.route("/tenant", methods=['GET'])
 @authorized
 def get(user_info):
     response_data = []
 
-    database_controller = DatabaseController(host=MONGO_HOST, port=MONGO_PORT)
+    database_controller = _get_database_controller()
     response_data = database_controller.read_tenants(user_info['id'])
 
     # Filter tenant members if user making the request is not the tenant owner
@@ -194,7 +365,7 @@ def get(user_info):
         if tenant['owner_id'] != user_info['id']:
             tenant['users'] = [user for user in tenant['users'] if user['id'] == user_info['id']]
 
-    return build_response(response_data, 200)
+    return build_conditional_response(response_data, 200)
 
 
 def is_member(user_id, tenant_info):
@@ -214,7 +385,7 @@ def is_member(user_id, tenant_info):
 def get_tenant(user_info, tenant_id):
     tenant_info = None
     try:
-        database_controller = DatabaseController(host=MONGO_HOST, port=MONGO_PORT)
+        database_controller = _get_database_controller()
         tenant_info = database_controller.get_tenant(tenant_id)
 
         if tenant_info is None:
@@ -229,16 +400,20 @@ def get_tenant(user_info, tenant_id):
 
         # Get tenant members from the IDM to keep the list
         # of members syncronized
-        keyrock_client = KeyrockClient(IDM_URL, IDM_USER, IDM_PASSWD)
+        keyrock_client = get_keyrock_client()
         members = keyrock_client.get_organization_members(tenant_info['tenant_organization'])
-        tenant_info['users'] = [{
+        users = [{
             'id': member['user_id'],
             'name': member['name'],
-            'roles': _map_roles(member)
+            'roles': [BROKER_CONSUMER_ROLE, BROKER_ADMIN_ROLE] if member['role'] == 'owner' else [BROKER_CONSUMER_ROLE]
         } for member in members if member['user_id'] != IDM_USER_ID]  # The admin user used to create the org is not a tenant member
 
-        database_controller.update_tenant(tenant_id, tenant_info)
+        # Only write the tenant when its members have changed in the IDM
+        if users != tenant_info['users']:
+            tenant_info['users'] = users
+            database_controller.update_tenant(tenant_id, tenant_info)
     except KeyrockError:
+        _log.warning('Error reading members of tenant %s', tenant_id, exc_info=True)
         return build_response({
             'error': 'An error occurred reading tenant info from Keyrock'
         }, 503)
@@ -246,7 +421,7 @@ def get_tenant(user_info, tenant_id):
     if tenant_info['owner_id'] != user_info['id']:
         tenant_info['users'] = [user for user in tenant_info['users'] if user['id'] == user_info['id']]
 
-    return build_response(tenant_info, 200)
+    return build_conditional_response(tenant_info, 200)
 
 
 def is_tenant_setting(setting, tenant_id):
@@ -265,7 +440,7 @@ def is_tenant_setting(setting, tenant_id):
 @authorized
 def delete_tenant(user_info, tenant_id):
     try:
-        database_controller = DatabaseController(host=MONGO_HOST, port=MONGO_PORT)
+        database_controller = _get_database_controller()
         tenant_info = database_controller.get_tenant(tenant_id)
 
         if tenant_info is None:
@@ -279,22 +454,18 @@ def delete_tenant(user_info, tenant_id):
             }, 403)
 
         # Delete organization in the IDM
-        keyrock_client = KeyrockClient(IDM_URL, IDM_USER, IDM_PASSWD)
+        keyrock_client = get_keyrock_client()
         keyrock_client.delete_organization(tenant_info['tenant_organization'])
 
         # Delete policies in API Umbrella
-        umbrella_client = UmbrellaClient(UMBRELLA_URL, UMBRELLA_TOKEN, UMBRELLA_KEY)
-        broker_api = umbrella_client.get_api_from_app_id(BROKER_APP_ID)
-
-        sub_settings = [setting for setting in broker_api['sub_settings']
-                        if not is_tenant_setting(setting, tenant_id)]
-
-        broker_api['sub_settings'] = sub_settings
-        umbrella_client.update_api(broker_api)
+        umbrella_client = _get_umbrella_client()
+        umbrella_client.remove_sub_url_settings_app_id(
+            BROKER_APP_ID, lambda setting: is_tenant_setting(setting, tenant_id))
 
         # Delete tenant from database
         database_controller.delete_tenant(tenant_id)
     except (KeyrockError, UmbrellaError) as e:
+        _log.warning('Error deleting tenant %s', tenant_id, exc_info=True)
         return build_response({
             'error': str(e)
         }, 503)
@@ -373,7 +544,7 @@ def process_users_diff(users_src, users_dst, roles_update=None):
 @consumes('application/json')
 def update_tenant(user_info, tenant_id):
     try:
-        database_controller = DatabaseController(host=MONGO_HOST, port=MONGO_PORT)
+        database_controller = _get_database_controller()
         tenant_info = database_controller.get_tenant(tenant_id)
 
         if tenant_info is None:
@@ -390,7 +561,7 @@ def update_tenant(user_info, tenant_id):
 
         # Apply JSON patch
         # Valid operations replace description, add user, remove user
-        keyrock_client = KeyrockClient(IDM_URL, IDM_USER, IDM_PASSWD)
+        keyrock_client = get_keyrock_client()
         tenant_update = patch.apply(tenant_info)
 
         if len(tenant_update) != len(tenant_info):
@@ -458,6 +629,7 @@ def update_tenant(user_info, tenant_id):
             'error': 'Invalid JSON PATCH format: ' + str(e)
         }, 400)
     except KeyrockError as e:
+        _log.warning('Error updating tenant %s', tenant_id, exc_info=True)
         return build_response({
             'error': str(e)
         }, 503)
@@ -470,13 +642,20 @@ def update_tenant(user_info, tenant_id):
 def get_users(user_info):
     try:
         # This method is just a proxy to the IDM for reading available users
-        keyrock_client = KeyrockClient(IDM_URL, IDM_USER, IDM_PASSWD)
-        return build_response(keyrock_client.get_users(), 200)
+        keyrock_client = get_keyrock_client()
+        response = build_response(keyrock_client.get_users(), 200)
     except KeyrockError as e:
+        _log.warning('Error reading users from Keyrock', exc_info=True)
         return build_response({
             'error': str(e)
         }, 503)
 
+    # The Keyrock client keeps the list for the same time
+    response.cache_control.private = True
+    response.cache_control.max_age = CACHE_MAX_AGE
+
+    return response
+
 
 @app.before_request
 def check_client_accpets_application_json():
@@ -505,6 +684,14 @@ def not_found(e):
     }, 404)
 
 
+@app.errorhandler(PyMongoError)
+def database_error(e):
+    _log.error('Error accessing the database', exc_info=e)
+    return build_response({
+        'error': 'An error occurred accessing the database'
+    }, 503)
+
+
 @app.errorhandler(500)
 def internal_server_error(e):
     return build_response({
@@ -513,8 +700,12 @@ def internal_server_error(e):
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', debug=(os.environ.get("DEBUG", "false").strip().lower() == "true"))
+    app.run(host='0.0.0.0', debug=_DEBUG)
 else:
     gunicorn_logger = logging.getLogger('gunicorn.error')
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
+    _log.handlers = gunicorn_logger.handlers
+    _log.setLevel(gunicorn_logger.level)
+
+    # Records are already written by the gunicorn handlers
+    _log.propagate = False
+    _log.info('Tenant manager worker started with pid %d', os.getpid())
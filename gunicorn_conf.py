@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Opplafy Tenant Manager
+# Copyright (C) 2019 Future Internet Consulting and Development Solutions S.L.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Gunicorn configuration. All the request handlers are IO bound (MongoDB,
+# Keyrock and API Umbrella), so gevent workers are used. The gevent worker
+# monkey patches the standard library before loading the application, so
+# requests, pymongo and threading cooperate with the event loop
+
+import multiprocessing
+import os
+
+
+bind = ':5000'
+
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gevent'
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+forwarded_allow_ips = '*'
+
+errorlog = '-'
+loglevel = os.environ.get('LOGLEVEL', 'info')
@@ -17,48 +17,102 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import logging
+from datetime import datetime, timedelta, timezone
+
 from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError, OperationFailure
 
 from bson import ObjectId
 
+from settings import MONGO_MAX_POOL_SIZE
+
+
+_log = logging.getLogger(__name__)
+
+# MongoDB error code of duplicated keys in a unique index
+DUPLICATE_KEY_CODE = 11000
+
+# Reservations of tenants whose creation never finished are removed after this time
+RESERVATION_TTL = 3600
+
+# Tenant creation jobs are removed a day after being created
+JOB_TTL = 86400
+
 
 class DatabaseController:
 
     _db = None
 
-    def __init__(self, host='localhost', port=27017):
-        self._db = MongoClient(host, port).tenant_manager
-
-    def save_tenant(self, tenant_id, name, description, owner, users, org_id, options={}):
+    def __init__(self, host='localhost', port=27017, max_pool_size=MONGO_MAX_POOL_SIZE):
+        # MongoClient is thread safe and keeps its own connection pool,
+        # so a single controller is expected to be shared by the process
+        self._db = MongoClient(host, port, maxPoolSize=max_pool_size).tenant_manager
+
+        try:
+            self._db.tenants.create_index('id', unique=True)
+        except OperationFailure as e:
+            if e.code == DUPLICATE_KEY_CODE:
+                # Databases created by previous versions may include duplicated tenants
+                _log.error('The tenant ID index cannot be created as the tenants collection contains '
+                           'duplicated IDs. Remove them as described in the README upgrade notes')
+            raise
+        self._db.tenants.create_index('reserved_at', expireAfterSeconds=RESERVATION_TTL)
+
+        # Each branch of the read_tenants query is resolved with its own index
+        self._db.tenants.create_index('owner_id')
+        self._db.tenants.create_index('users.id')
+
+        self._db.tenant_jobs.create_index('id', unique=True)
+        self._db.tenant_jobs.create_index('created_at', expireAfterSeconds=JOB_TTL)
+
+    def reserve_tenant(self, tenant_id, name, description, owner, options={}):
+        """
+        Stores a new tenant pending to be completed with its organization and
+        users. Returns False if the tenant ID is already in use
+        """
         tenant_document = {
             'id': tenant_id,
             'owner_id': owner,
-            'tenant_organization': org_id,
+            'tenant_organization': None,
             'name': name,
             'description': description,
-            'users': users,
-            'options': options
+            'users': [],
+            'options': options,
+            'reserved_at': datetime.now(timezone.utc)
         }
 
-        self._db.tenants.insert_one(tenant_document)
-
-    def read_tenants(self, owner):
-        def serialize_ids(t):
-            del t['_id']
-            return t
+        try:
+            self._db.tenants.insert_one(tenant_document)
+        except DuplicateKeyError:
+            return False
 
-        return [serialize_ids(tenant)
-            for tenant in self._db.tenants.find({"$or":[ {'owner_id': owner}, {'users.id': owner} ]})]
+        return True
 
-    def get_tenant(self, tenant_id):
-        tenant = self._db.tenants.find_one({
+    def complete_tenant(self, tenant_id, users, org_id):
+        self._db.tenants.update_one({
             'id': tenant_id
+        }, {
+            '$set': {
+                'tenant_organization': org_id,
+                'users': users
+            },
+            '$unset': {
+                'reserved_at': ''
+            }
         })
 
-        if tenant is not None:
-            del tenant['_id']
+    def read_tenants(self, owner):
+        return list(self._db.tenants.find({
+            "$or": [{'owner_id': owner}, {'users.id': owner}],
+            'reserved_at': {'$exists': False}
+        }, projection={'_id': False}))
 
-        return tenant
+    def get_tenant(self, tenant_id):
+        return self._db.tenants.find_one({
+            'id': tenant_id,
+            'reserved_at': {'$exists': False}
+        }, projection={'_id': False})
 
     def delete_tenant(self, tenant_id):
         self._db.tenants.delete_one({
@@ -69,3 +123,45 @@ class DatabaseController:
         self._db.tenants.replace_one({
             'id': tenant_id
         }, tenant)
+
+    def save_job(self, job_id, owner, tenant_id):
+        self._db.tenant_jobs.insert_one({
+            'id': job_id,
+            'owner_id': owner,
+            'tenant_id': tenant_id,
+            'status': 'pending',
+            'created_at': datetime.now(timezone.utc)
+        })
+
+    def update_job(self, job_id, status, error=None):
+        update = {
+            'status': status
+        }
+
+        if error is not None:
+            update['error'] = error
+
+        self._db.tenant_jobs.update_one({
+            'id': job_id
+        }, {
+            '$set': update
+        })
+
+    def get_job(self, job_id):
+        job = self._db.tenant_jobs.find_one({
+            'id': job_id
+        }, projection={'_id': False})
+
+        if job is None:
+            return job
+
+        # A job still pending when its tenant reservation has expired was lost,
+        # e.g. because the worker running it was restarted
+        created_at = job.pop('created_at', None)
+        if job['status'] == 'pending' and created_at is not None and \
+                datetime.now(timezone.utc) - created_at.replace(tzinfo=timezone.utc) > timedelta(seconds=RESERVATION_TTL):
+
+            job['status'] = 'failed'
+            job['error'] = 'The tenant creation did not finish'
+
+        return job
@@ -17,11 +17,31 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import requests
+import threading
+import time
+from datetime import datetime, timezone
 
 from urllib.parse import urljoin
+
+from cachetools import TTLCache
+
+from lib.sessions import build_session
 from settings import VERIFY_REQUESTS
 
+
+# Keyrock API tokens are valid for one hour unless configured otherwise
+DEFAULT_TOKEN_LIFETIME = 3600
+
+# Seconds before the token expiration when a new one is requested
+TOKEN_EXPIRY_MARGIN = 30
+
+# User name to user ID resolutions are cached for a few minutes
+USER_ID_CACHE_SIZE = 10000
+USER_ID_CACHE_TTL = 300
+
+# The list of available users is polled by dashboards, so it is kept a few seconds
+USERS_CACHE_TTL = 5
+
 class KeyrockError(Exception):
     pass
 
@@ -29,16 +49,54 @@ class KeyrockError(Exception):
 class KeyrockClient():
 
     _access_token = None
+    _token_expiry = 0
     _host = None
 
-    def __init__(self, host, user, passwd):
+    def __init__(self, host, user, passwd, executor=None):
         self._host = host
+        self._executor = executor
+        self._user = user
+        self._passwd = passwd
+        self._login_lock = threading.Lock()
+        self._session = build_session()
+
+        self._user_id_cache = TTLCache(USER_ID_CACHE_SIZE, USER_ID_CACHE_TTL)
+        self._user_id_lock = threading.Lock()
+
+        self._users_cache = TTLCache(1, USERS_CACHE_TTL)
+        self._users_lock = threading.Lock()
+
         self.login(user, passwd)
 
-    def _list_resources(self, url, err):
-        response = requests.get(url, headers={
+    def _refresh_token(self, expired_token):
+        with self._login_lock:
+            # Other thread may have already renewed the token
+            if self._access_token == expired_token:
+                self.login(self._user, self._passwd)
+
+    def _request(self, method, url, **kwargs):
+        """
+        Makes a request authenticated with the admin token, which is renewed
+        when it is about to expire or when Keyrock rejects it
+        """
+        token = self._access_token
+        if time.time() > self._token_expiry - TOKEN_EXPIRY_MARGIN:
+            self._refresh_token(token)
+
+        response = method(url, headers={
             'X-Auth-Token': self._access_token
-        }, verify=VERIFY_REQUESTS)
+        }, **kwargs)
+
+        if response.status_code == 401:
+            self._refresh_token(token)
+            response = method(url, headers={
+                'X-Auth-Token': self._access_token
+            }, **kwargs)
+
+        return response
+
+    def _list_resources(self, url, err):
+        response = self._request(self._session.get, url, verify=VERIFY_REQUESTS)
 
         if response.status_code != 200:
             raise KeyrockError(err)
@@ -52,17 +110,23 @@ class KeyrockClient():
         }
 
         url = urljoin(self._host, '/v3/auth/tokens')
-        response = requests.post(url, json=body, verify=VERIFY_REQUESTS)
+        response = self._session.post(url, json=body, verify=VERIFY_REQUESTS)
 
         response.raise_for_status()
         self._access_token = response.headers['x-subject-token']
 
+        try:
+            expires_at = datetime.strptime(response.json()['token']['expires_at'], '%Y-%m-%dT%H:%M:%S.%fZ')
+            self._token_expiry = expires_at.replace(tzinfo=timezone.utc).timestamp()
+        except (KeyError, TypeError, ValueError):
+            self._token_expiry = time.time() + DEFAULT_TOKEN_LIFETIME
+
     def authorize(self, token):
         """
         Validates the given access token and returns user info if valid
         """
         url = urljoin(self._host, '/user?access_token=' + token)
-        response = requests.get(url)
+        response = self._session.get(url)
 
         if response.status_code != 201:
             raise KeyrockError('Invalid access token')
@@ -82,9 +146,7 @@ class KeyrockClient():
             }
         }
 
-        response = requests.post(url, headers={
-            'X-Auth-Token': self._access_token
-        }, json=body, verify=VERIFY_REQUESTS)
+        response = self._request(self._session.post, url, json=body, verify=VERIFY_REQUESTS)
 
         if response.status_code != 201:
             raise KeyrockError('Keyrock failed assigning role {} in organization'.format(role_id))
@@ -95,9 +157,7 @@ class KeyrockClient():
         """
         url = urljoin(self._host, '/v1/organizations/{}/users/{}/organization_roles/{}'.format(organization_id, owner, role_id))
 
-        response = requests.delete(url, headers={
-            'X-Auth-Token': self._access_token
-        }, verify=VERIFY_REQUESTS)
+        response = self._request(self._session.delete, url, verify=VERIFY_REQUESTS)
 
         if response.status_code != 204:
             raise KeyrockError('Keyrock failed revoking role {} in organization'.format(role_id))
@@ -106,9 +166,7 @@ class KeyrockClient():
         """
         """
         url = urljoin(self._host, '/v1/applications/{}/users/{}/roles/{}'.format(app_id, user, role_id))
-        response = requests.post(url, headers={
-            'X-Auth-Token': self._access_token
-        }, verify=VERIFY_REQUESTS)
+        response = self._request(self._session.post, url, verify=VERIFY_REQUESTS)
 
         if response.status_code != 201:
             raise KeyrockError('Keyrock failed assigning role')
@@ -123,9 +181,7 @@ class KeyrockClient():
             }
         }
 
-        response = requests.post(url, headers={
-            'X-Auth-Token': self._access_token
-        }, json=body, verify=VERIFY_REQUESTS)
+        response = self._request(self._session.post, url, json=body, verify=VERIFY_REQUESTS)
 
         if response.status_code != 201:
             raise KeyrockError('Keyrock failed creating role')
@@ -162,9 +218,7 @@ class KeyrockClient():
             }
         }
 
-        response = requests.post(url, headers={
-            'X-Auth-Token': self._access_token
-        }, json=body, verify=VERIFY_REQUESTS)
+        response = self._request(self._session.post, url, json=body, verify=VERIFY_REQUESTS)
 
         if response.status_code != 201:
             raise KeyrockError('Keyrock failed creating application')
@@ -177,9 +231,7 @@ class KeyrockClient():
         """
         # Create organization using provided info
         url = urljoin(self._host, '/v1/organizations')
-        response = requests.post(url, headers={
-            'X-Auth-Token': self._access_token
-        }, json={
+        response = self._request(self._session.post, url, json={
             'organization': {
                 'name': name,
                 'description': description
@@ -197,9 +249,7 @@ class KeyrockClient():
 
     def delete_organization(self, org_id):
         url = urljoin(self._host, '/v1/organizations/{}'.format(org_id))
-        response = requests.delete(url, headers={
-            'X-Auth-Token': self._access_token
-        }, verify=VERIFY_REQUESTS)
+        response = self._request(self._session.delete, url, verify=VERIFY_REQUESTS)
 
         if response.status_code != 204:
             raise KeyrockError('Keyrock failed deleting organization')
@@ -210,17 +260,13 @@ class KeyrockClient():
             'organization': update
         }
 
-        response = requests.patch(url, headers={
-            'X-Auth-Token': self._access_token
-        }, json=body, verify=VERIFY_REQUESTS)
+        response = self._request(self._session.patch, url, json=body, verify=VERIFY_REQUESTS)
 
         if response.status_code != 200:
             raise KeyrockError('Keyrock failed updating organization')
 
     def _search_id(self, url, name, search_elem, key):
-        response = requests.get(url, headers={
-            'X-Auth-Token': self._access_token
-        }, verify=VERIFY_REQUESTS)
+        response = self._request(self._session.get, url, verify=VERIFY_REQUESTS)
 
         if response.status_code != 200:
             raise KeyrockError('{} {} cannot be found'.format(search_elem, name))
@@ -236,8 +282,17 @@ class KeyrockClient():
         return id_
 
     def get_user_id(self, user_name):
-        url = urljoin(self._host, '/v1/users')
-        return self._search_id(url, user_name, 'User', 'username')
+        with self._user_id_lock:
+            user_id = self._user_id_cache.get(user_name)
+
+        if user_id is None:
+            url = urljoin(self._host, '/v1/users')
+            user_id = self._search_id(url, user_name, 'User', 'username')
+
+            with self._user_id_lock:
+                self._user_id_cache[user_name] = user_id
+
+        return user_id
 
     def get_role_id(self, app_id, role):
         """
@@ -260,9 +315,7 @@ class KeyrockClient():
             }
         }
 
-        response = requests.post(url, headers={
-            'X-Auth-Token': self._access_token
-        }, json=body, verify=VERIFY_REQUESTS)
+        response = self._request(self._session.post, url, json=body, verify=VERIFY_REQUESTS)
 
         if response.status_code != 201:
             raise KeyrockError('Role {} cannot be asigned to organization'.format(app_role))
@@ -283,9 +336,7 @@ class KeyrockClient():
         """
         url = urljoin(self._host, '/v1/users/{}'.format(user_id))
 
-        response = requests.get(url, headers={
-            'X-Auth-Token': self._access_token
-        }, verify=VERIFY_REQUESTS)
+        response = self._request(self._session.get, url, verify=VERIFY_REQUESTS)
 
         if response.status_code != 200:
             raise KeyrockError('It could not be possible to retrieve user info')
@@ -296,15 +347,22 @@ class KeyrockClient():
         """
         Returns the list of available users
         """
-        url = urljoin(self._host, '/v1/users')
-        response = requests.get(url, headers={
-            'X-Auth-Token': self._access_token
-        }, verify=VERIFY_REQUESTS)
+        with self._users_lock:
+            users = self._users_cache.get('users')
 
-        if response.status_code != 200:
-            raise KeyrockError('It could not be possible to retrieve user info')
+        if users is None:
+            url = urljoin(self._host, '/v1/users')
+            response = self._request(self._session.get, url, verify=VERIFY_REQUESTS)
 
-        return response.json()
+            if response.status_code != 200:
+                raise KeyrockError('It could not be possible to retrieve user info')
+
+            users = response.json()
+
+            with self._users_lock:
+                self._users_cache['users'] = users
+
+        return users
 
     def get_organization_members(self, organization_id):
         """
@@ -312,15 +370,18 @@ class KeyrockClient():
         """
         url = urljoin(self._host, '/v1/organizations/{}/users'.format(organization_id))
 
-        response = requests.get(url, headers={
-            'X-Auth-Token': self._access_token
-        }, verify=VERIFY_REQUESTS)
+        response = self._request(self._session.get, url, verify=VERIFY_REQUESTS)
 
         if response.status_code != 200:
             raise KeyrockError('It could not be possible to retrieve organization members')
 
         members = response.json()['organization_users']
-        for member in members:
-            member['name'] = self.get_user(member['user_id'])['username']
+
+        # Member names are retrieved concurrently when an executor is provided
+        map_users = self._executor.map if self._executor is not None else map
+        users = map_users(lambda member: self.get_user(member['user_id']), members)
+
+        for member, user in zip(members, users):
+            member['name'] = user['username']
 
         return members
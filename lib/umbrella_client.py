@@ -17,10 +17,12 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import requests
-
+import threading
+from collections import deque
+from concurrent.futures import Future
 from urllib.parse import urlparse, urljoin
 
+from lib.sessions import build_session
 from settings import VERIFY_REQUESTS
 
 
@@ -44,6 +46,12 @@ class UmbrellaClient():
         self._host = host
         self._admin_token = admin_token
         self._api_key = api_key
+        self._session = build_session()
+
+        # Sub settings waiting to be added and lock serializing API updates
+        self._queue = deque()
+        self._queue_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
 
     def get_api_from_app_id(self, app_id):
         """
@@ -58,7 +66,7 @@ class UmbrellaClient():
 
         while not processed:
             page_url = url + '?start={}&length={}'.format(start, PAGE_LEN)
-            response = requests.get(page_url, headers={
+            response = self._session.get(page_url, headers={
                 'X-Api-Key': self._api_key,
                 'X-Admin-Auth-Token': self._admin_token
             }, verify=VERIFY_REQUESTS)
@@ -92,7 +100,7 @@ class UmbrellaClient():
             'api': api_elem
         }
 
-        response = requests.put(url, headers={
+        response = self._session.put(url, headers={
             'X-Api-Key': self._api_key,
             'X-Admin-Auth-Token': self._admin_token
         }, json={'api': api_elem}, verify=VERIFY_REQUESTS)
@@ -118,6 +126,65 @@ class UmbrellaClient():
         api_elem['sub_settings'].extend(sub_settings)
         self.update_api(api_elem)
 
+    def remove_sub_url_settings_app_id(self, app_id, is_removed):
+        """
+        Removes the sub URL settings matching is_removed from an API Umbrella
+        API identified by IDM app ID. The API is updated holding the same lock
+        as the queued additions, so neither update overwrites the other
+        """
+        with self._flush_lock:
+            api_elem = self.get_api_from_app_id(app_id)
+            api_elem['sub_settings'] = [setting for setting in api_elem.get('sub_settings') or []
+                                        if not is_removed(setting)]
+
+            self.update_api(api_elem)
+
+    def queue_sub_url_setting_app_id(self, app_id, sub_settings):
+        """
+        Appends new sub URL settings like add_sub_url_setting_app_id, but the
+        settings queued by concurrent callers are added in a single API update.
+        It returns once the settings have been published
+        """
+        future = Future()
+        with self._queue_lock:
+            self._queue.append((app_id, sub_settings, future))
+
+        with self._flush_lock:
+            # The settings may have been added by the previous flush
+            if not future.done():
+                self._flush_queue()
+
+        future.result()
+
+    def _flush_queue(self):
+        with self._queue_lock:
+            pending = list(self._queue)
+            self._queue.clear()
+
+        batches = {}
+        for app_id, sub_settings, future in pending:
+            settings, futures = batches.setdefault(app_id, ([], []))
+            settings.extend(sub_settings)
+            futures.append(future)
+
+        try:
+            for app_id, (settings, futures) in batches.items():
+                try:
+                    self.add_sub_url_setting_app_id(app_id, settings)
+                except Exception as e:
+                    for future in futures:
+                        future.set_exception(e)
+                else:
+                    for future in futures:
+                        future.set_result(None)
+        except BaseException as e:
+            # The flush can be interrupted (e.g. by a gevent timeout). The other
+            # callers of the batch are waiting on their futures, so resolve them
+            for _, _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            raise
+
     def publish(self):
         headers = {
             'X-Api-Key': self._api_key,
@@ -126,7 +193,7 @@ class UmbrellaClient():
 
         # Retriveve the list of changes to be published
         url = urljoin(self._host, PENDING_CHANGES_ENDPOINT)
-        response = requests.get(url, headers=headers, verify=VERIFY_REQUESTS)
+        response = self._session.get(url, headers=headers, verify=VERIFY_REQUESTS)
         changes = response.json()
 
         # Prepare body for publishing the changes
@@ -142,7 +209,7 @@ class UmbrellaClient():
             }
 
         url = urljoin(self._host, PUBLISH_ENDPOINT)
-        response = requests.post(url, json=body, headers=headers, verify=VERIFY_REQUESTS)
+        response = self._session.post(url, json=body, headers=headers, verify=VERIFY_REQUESTS)
         if response.status_code == 403:
             error = response.json()
             if "error" in error and "message" in error["error"]:
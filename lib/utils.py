@@ -18,23 +18,89 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from flask import request, make_response
+from flask.json.provider import DefaultJSONProvider
 import mimeparse
 
+try:
+    import orjson
+except ImportError:
+    # orjson is not available for every interpreter (e.g. PyPy)
+    orjson = None
+
 from lib.keyrock_client import KeyrockClient, KeyrockError
 from lib.urlify import URLify
 from settings import IDM_URL, IDM_PASSWD, IDM_USER
 
-__all__ = ["authorized", "build_response", "consumes", "URLify"]
+__all__ = ["authorized", "build_conditional_response", "build_response", "consumes", "get_keyrock_client",
+           "io_pool", "OrjsonProvider", "URLify"]
+
+# Seconds a client can reuse a cached response before revalidating it
+CACHE_MAX_AGE = 5
+
+# Pool used to issue independent requests to the IDM concurrently
+io_pool = ThreadPoolExecutor(max_workers=16)
+
+_keyrock_client = None
+_keyrock_lock = threading.Lock()
+
+
+def get_keyrock_client():
+    """
+    Returns the Keyrock client of the process, created on first use. It is
+    shared by every request so its admin token, session and caches are reused
+    """
+    global _keyrock_client
+
+    if _keyrock_client is None:
+        with _keyrock_lock:
+            if _keyrock_client is None:
+                _keyrock_client = KeyrockClient(IDM_URL, IDM_USER, IDM_PASSWD, executor=io_pool)
+
+    return _keyrock_client
+
+
+def _dumps(body):
+    if orjson is not None:
+        return orjson.dumps(body)
+
+    return json.dumps(body)
 
 
 def build_response(body, status):
-    resp = make_response(json.dumps(body), status)
+    resp = make_response(_dumps(body), status)
     resp.headers['Content-Type'] = 'application/json'
     return resp
 
 
+def build_conditional_response(body, status):
+    """
+    Builds a JSON response tagged with the ETag of its body. A 304 Not Modified
+    response is returned instead when the request includes a matching If-None-Match
+    """
+    resp = build_response(body, status)
+    resp.cache_control.private = True
+    resp.cache_control.max_age = CACHE_MAX_AGE
+    resp.add_etag()
+
+    return resp.make_conditional(request)
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider that parses request bodies with orjson when available
+    """
+
+    def loads(self, s, **kwargs):
+        if orjson is not None:
+            return orjson.loads(s)
+
+        return super().loads(s, **kwargs)
+
+
 def authorized(funct):
     def wrapper(*args, **kwargs):
         if 'authorization' not in request.headers or \
@@ -44,7 +110,7 @@ def authorized(funct):
                 'error': 'This request requires authentication'
             }, 401)
 
-        keyrock_client = KeyrockClient(IDM_URL, IDM_USER, IDM_PASSWD)
+        keyrock_client = get_keyrock_client()
 
         # Authorize user making the request
         token = request.headers.get('authorization').split(' ')[1]
@@ -26,6 +26,7 @@ VERIFY_REQUESTS = True
 # Configure using env variables
 MONGO_HOST = os.environ.get('MONGO_HOST', 'mongo')
 MONGO_PORT = os.environ.get('MONGO_PORT', 27017)
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', 50))
 
 IDM_URL = os.environ.get('IDM_URL', 'http://keyrock:3000')
 IDM_USER = os.environ.get('IDM_USER', 'fdelavega@conwet.com')
@@ -17,10 +17,18 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import json
+import threading
+import time
 import unittest
+from concurrent.futures import Future, ThreadPoolExecutor
 from unittest.mock import ANY, call, MagicMock, patch
 from importlib import reload
 
+import flask
+from flask import Flask
+from pymongo.errors import PyMongoError
+
 import controller
 from lib import keyrock_client, umbrella_client, utils
 from settings import VERIFY_REQUESTS
@@ -38,11 +46,16 @@ class UtilsTestCase(unittest.TestCase):
         self._keyrock_client.authorize.return_value = self._user_info
 
         utils.KeyrockClient = MagicMock(return_value=self._keyrock_client)
+        utils._keyrock_client = None
         self._response = MagicMock()
 
         utils.make_response = MagicMock(return_value=self._response)
         utils.request = MagicMock()
 
+    def _assert_response(self, body, status):
+        utils.make_response.assert_called_once_with(ANY, status)
+        self.assertEqual(body, json.loads(utils.make_response.call_args[0][0]))
+
     def test_authorization_decorator(self):
         expected_response = {}
         exp_id = '1'
@@ -74,7 +87,7 @@ class UtilsTestCase(unittest.TestCase):
         resp = wrapper()
 
         self.assertEqual(self._response, resp)
-        utils.make_response.assert_called_once_with('{"error": "This request requires authentication"}', 401)
+        self._assert_response({'error': 'This request requires authentication'}, 401)
 
         self.assertEqual(0, self._keyrock_client.authorize.call_count)
 
@@ -93,10 +106,47 @@ class UtilsTestCase(unittest.TestCase):
         resp = wrapper()
 
         self.assertEqual(self._response, resp)
-        utils.make_response.assert_called_once_with('{"error": "This request requires authentication"}', 401)
+        self._assert_response({'error': 'This request requires authentication'}, 401)
 
         self._keyrock_client.authorize.assert_called_once_with(self._token)
 
+    def test_keyrock_client_shared(self):
+        client = utils.get_keyrock_client()
+
+        self.assertEqual(self._keyrock_client, client)
+        self.assertEqual(client, utils.get_keyrock_client())
+        utils.KeyrockClient.assert_called_once_with(ANY, ANY, ANY, executor=utils.io_pool)
+
+    def test_orjson_provider_loads(self):
+        app = Flask(__name__)
+        app.json = utils.OrjsonProvider(app)
+
+        body = {
+            'name': 'Tenant',
+            'users': [{'name': 'user', 'roles': ['data-consumer']}]
+        }
+        with app.test_request_context(method='POST', data=json.dumps(body), content_type='application/json'):
+            self.assertEqual(body, flask.request.get_json())
+
+    def test_conditional_response(self):
+        utils.make_response = flask.make_response
+        utils.request = flask.request
+
+        app = Flask(__name__)
+        body = [{'id': 'tenant'}]
+
+        with app.test_request_context():
+            resp = utils.build_conditional_response(body, 200)
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('private, max-age=5', resp.headers['Cache-Control'])
+        etag = resp.headers['ETag']
+
+        with app.test_request_context(headers={'If-None-Match': etag}):
+            resp = utils.build_conditional_response(body, 200)
+
+        self.assertEqual(304, resp.status_code)
+
 
 class KeyrockClientTestCase(unittest.TestCase):
 
@@ -115,12 +165,13 @@ class KeyrockClientTestCase(unittest.TestCase):
     }
 
     def setUp(self):
-        keyrock_client.requests = MagicMock()
+        self._session = MagicMock()
+        keyrock_client.build_session = MagicMock(return_value=self._session)
 
     def test_authorize_user(self):
         # Mock login
         response = MagicMock(status_code=201, headers={'x-subject-token': self._x_subject_token})
-        keyrock_client.requests.post.return_value = response
+        self._session.post.return_value = response
 
         # Mock authorization request
         user_response = MagicMock(status_code=201)
@@ -130,7 +181,7 @@ class KeyrockClientTestCase(unittest.TestCase):
         }
         user_response.json.return_value = expected_info
 
-        keyrock_client.requests.get.return_value = user_response
+        self._session.get.return_value = user_response
 
         client = keyrock_client.KeyrockClient(self._host, self._user, self._passwd)
         token = 'access_token'
@@ -139,15 +190,15 @@ class KeyrockClientTestCase(unittest.TestCase):
         # validate calls
         self.assertEqual(expected_info, info)
 
-        keyrock_client.requests.post.assert_called_once_with('http://idm.docker:3000/v3/auth/tokens', json=self._exp_body, verify=VERIFY_REQUESTS)
-        keyrock_client.requests.get.assert_called_once_with('http://idm.docker:3000/user?access_token=access_token')
+        self._session.post.assert_called_once_with('http://idm.docker:3000/v3/auth/tokens', json=self._exp_body, verify=VERIFY_REQUESTS)
+        self._session.get.assert_called_once_with('http://idm.docker:3000/user?access_token=access_token')
         user_response.json.assert_called_once_with()
 
     def test_authorize_user_invalid_token(self):
         response = MagicMock(status_code=201, headers={'x-subject-token': self._x_subject_token})
-        keyrock_client.requests.post.return_value = response
+        self._session.post.return_value = response
 
-        keyrock_client.requests.get.return_value = MagicMock(status_code=403)
+        self._session.get.return_value = MagicMock(status_code=403)
 
         client = keyrock_client.KeyrockClient(self._host, self._user, self._passwd)
         error = False
@@ -162,9 +213,9 @@ class KeyrockClientTestCase(unittest.TestCase):
     def test_get_user_id_request_error(self):
         response = MagicMock(status_code=201, headers={'x-subject-token': self._x_subject_token})
 
-        keyrock_client.requests.post.return_value = response
+        self._session.post.return_value = response
 
-        keyrock_client.requests.get.return_value = MagicMock(status_code=400)
+        self._session.get.return_value = MagicMock(status_code=400)
 
         client = keyrock_client.KeyrockClient(self._host, self._user, self._passwd)
         error = False
@@ -179,14 +230,14 @@ class KeyrockClientTestCase(unittest.TestCase):
     def test_get_user_id_not_found(self):
         response = MagicMock(status_code=201, headers={'x-subject-token': self._x_subject_token})
 
-        keyrock_client.requests.post.return_value = response
+        self._session.post.return_value = response
 
         get_response = MagicMock(status_code=200)
         get_response.json.return_value = {
             'users': []
         }
 
-        keyrock_client.requests.get.return_value = get_response
+        self._session.get.return_value = get_response
 
         client = keyrock_client.KeyrockClient(self._host, self._user, self._passwd)
         error = False
@@ -198,6 +249,28 @@ class KeyrockClientTestCase(unittest.TestCase):
 
         self.assertTrue(error)
 
+    def test_get_user_id_cached(self):
+        response = MagicMock(status_code=201, headers={'x-subject-token': self._x_subject_token})
+
+        self._session.post.return_value = response
+
+        get_response = MagicMock(status_code=200)
+        get_response.json.return_value = {
+            'users': [{
+                'id': 'user_id',
+                'username': 'user_name'
+            }]
+        }
+
+        self._session.get.return_value = get_response
+
+        client = keyrock_client.KeyrockClient(self._host, self._user, self._passwd)
+
+        self.assertEqual('user_id', client.get_user_id('user_name'))
+        self.assertEqual('user_id', client.get_user_id('user_name'))
+
+        self._session.get.assert_called_once_with('http://idm.docker:3000/v1/users', headers=self._headers, verify=VERIFY_REQUESTS)
+
     def test_create_organization(self):
         # Mock HTTP requests
         login_response = MagicMock(status_code=201, headers={'x-subject-token': self._x_subject_token})
@@ -212,7 +285,7 @@ class KeyrockClientTestCase(unittest.TestCase):
 
         role_response = MagicMock(status_code=201)
 
-        keyrock_client.requests.post.side_effect = [login_response, create_response, role_response]
+        self._session.post.side_effect = [login_response, create_response, role_response]
 
         client = keyrock_client.KeyrockClient(self._host, self._user, self._passwd)
         org_id = client.create_organization('organization', 'description', 'owner')
@@ -233,7 +306,7 @@ class KeyrockClientTestCase(unittest.TestCase):
                 'organization_id': 'org_id'
             }
         }
-        post_calls = keyrock_client.requests.post.call_args_list
+        post_calls = self._session.post.call_args_list
         self.assertEqual([
             call('http://idm.docker:3000/v3/auth/tokens', json=self._exp_body, verify=VERIFY_REQUESTS),
             call('http://idm.docker:3000/v1/organizations', headers=self._headers, json=org_body, verify=VERIFY_REQUESTS),
@@ -243,7 +316,7 @@ class KeyrockClientTestCase(unittest.TestCase):
     def test_create_organization_error(self):
         login_response = MagicMock(status_code=201, headers={'x-subject-token': self._x_subject_token})
 
-        keyrock_client.requests.post.side_effect = [login_response, MagicMock(status_code=400)]
+        self._session.post.side_effect = [login_response, MagicMock(status_code=400)]
 
         client = keyrock_client.KeyrockClient(self._host, self._user, self._passwd)
 
@@ -259,7 +332,7 @@ class KeyrockClientTestCase(unittest.TestCase):
     def test_grant_organization_role_error(self):
         login_response = MagicMock(status_code=201, headers={'x-subject-token': self._x_subject_token})
 
-        keyrock_client.requests.post.side_effect = [login_response, MagicMock(status_code=400)]
+        self._session.post.side_effect = [login_response, MagicMock(status_code=400)]
 
         client = keyrock_client.KeyrockClient(self._host, self._user, self._passwd)
 
@@ -274,21 +347,21 @@ class KeyrockClientTestCase(unittest.TestCase):
 
     def test_delete_organization(self):
         login_response = MagicMock(status_code=201, headers={'x-subject-token': self._x_subject_token})
-        keyrock_client.requests.post.side_effect = [login_response]
+        self._session.post.side_effect = [login_response]
 
-        keyrock_client.requests.delete.return_value = MagicMock(status_code=204)
+        self._session.delete.return_value = MagicMock(status_code=204)
 
         client = keyrock_client.KeyrockClient(self._host, self._user, self._passwd)
         client.delete_organization('org_id')
 
-        keyrock_client.requests.post.assert_called_once_with('http://idm.docker:3000/v3/auth/tokens', json=self._exp_body, verify=VERIFY_REQUESTS)
-        keyrock_client.requests.delete.assert_called_once_with('http://idm.docker:3000/v1/organizations/org_id', headers=self._headers, verify=VERIFY_REQUESTS)
+        self._session.post.assert_called_once_with('http://idm.docker:3000/v3/auth/tokens', json=self._exp_body, verify=VERIFY_REQUESTS)
+        self._session.delete.assert_called_once_with('http://idm.docker:3000/v1/organizations/org_id', headers=self._headers, verify=VERIFY_REQUESTS)
 
     def test_delete_organization_error(self):
         login_response = MagicMock(status_code=201, headers={'x-subject-token': self._x_subject_token})
 
-        keyrock_client.requests.post.return_value = login_response
-        keyrock_client.requests.delete.return_value = MagicMock(status_code=403)
+        self._session.post.return_value = login_response
+        self._session.delete.return_value = MagicMock(status_code=403)
 
         client = keyrock_client.KeyrockClient(self._host, self._user, self._passwd)
 
@@ -303,20 +376,20 @@ class KeyrockClientTestCase(unittest.TestCase):
 
     def test_revoke_organization_roles(self):
         login_response = MagicMock(status_code=201, headers={'x-subject-token': self._x_subject_token})
-        keyrock_client.requests.post.side_effect = [login_response]
+        self._session.post.side_effect = [login_response]
 
-        keyrock_client.requests.delete.return_value = MagicMock(status_code=204)
+        self._session.delete.return_value = MagicMock(status_code=204)
 
         client = keyrock_client.KeyrockClient(self._host, self._user, self._passwd)
         client.revoke_organization_role('org_id', 'user', 'owner')
 
-        keyrock_client.requests.post.assert_called_once_with('http://idm.docker:3000/v3/auth/tokens', json=self._exp_body, verify=VERIFY_REQUESTS)
-        keyrock_client.requests.delete.assert_called_once_with('http://idm.docker:3000/v1/organizations/org_id/users/user/organization_roles/owner', headers=self._headers, verify=VERIFY_REQUESTS)
+        self._session.post.assert_called_once_with('http://idm.docker:3000/v3/auth/tokens', json=self._exp_body, verify=VERIFY_REQUESTS)
+        self._session.delete.assert_called_once_with('http://idm.docker:3000/v1/organizations/org_id/users/user/organization_roles/owner', headers=self._headers, verify=VERIFY_REQUESTS)
 
     def test_revoke_organization_role_error(self):
         login_response = MagicMock(status_code=201, headers={'x-subject-token': self._x_subject_token})
 
-        keyrock_client.requests.post.side_effect = [login_response, MagicMock(status_code=400)]
+        self._session.post.side_effect = [login_response, MagicMock(status_code=400)]
 
         client = keyrock_client.KeyrockClient(self._host, self._user, self._passwd)
 
@@ -349,14 +422,14 @@ class KeyrockClientTestCase(unittest.TestCase):
         # Mock authorize organization
         authorize_response = MagicMock(status_code=201)
 
-        keyrock_client.requests.get.return_value = get_roles_response
-        keyrock_client.requests.post.side_effect = [login_response, authorize_response, authorize_response, authorize_response]
+        self._session.get.return_value = get_roles_response
+        self._session.post.side_effect = [login_response, authorize_response, authorize_response, authorize_response]
 
         client = keyrock_client.KeyrockClient(self._host, self._user, self._passwd)
         client.authorize_organization('org_id', 'app_id', 'data-provider', 'data-consumer')
 
         # Validate calls
-        get_calls = keyrock_client.requests.get.call_args_list
+        get_calls = self._session.get.call_args_list
         self.assertEqual([
             call('http://idm.docker:3000/v1/applications/app_id/roles', headers=self._headers, verify=VERIFY_REQUESTS),
             call('http://idm.docker:3000/v1/applications/app_id/roles', headers=self._headers, verify=VERIFY_REQUESTS),
@@ -390,7 +463,7 @@ class KeyrockClientTestCase(unittest.TestCase):
             }
         }
 
-        post_calls = keyrock_client.requests.post.call_args_list
+        post_calls = self._session.post.call_args_list
         self.assertEqual([
             call('http://idm.docker:3000/v3/auth/tokens', json=self._exp_body, verify=VERIFY_REQUESTS),
             call('http://idm.docker:3000/v1/applications/app_id/organizations/org_id/roles/1/organization_roles/owner', json=owner_body, headers=self._headers, verify=VERIFY_REQUESTS),
@@ -418,8 +491,8 @@ class KeyrockClientTestCase(unittest.TestCase):
         get_user_response = MagicMock(status_code=200)
         get_user_response.json.return_value = user
 
-        keyrock_client.requests.post.return_value = login_response
-        keyrock_client.requests.get.side_effect = [get_members_response, get_user_response]
+        self._session.post.return_value = login_response
+        self._session.get.side_effect = [get_members_response, get_user_response]
 
         client = keyrock_client.KeyrockClient(self._host, self._user, self._passwd)
         members_response = client.get_organization_members(org_id)
@@ -430,12 +503,51 @@ class KeyrockClientTestCase(unittest.TestCase):
         }]
         self.assertEqual(exp_response, members_response)
 
-        get_calls = keyrock_client.requests.get.call_args_list
+        get_calls = self._session.get.call_args_list
         self.assertEqual([
             call('http://idm.docker:3000/v1/organizations/org_id/users', headers=self._headers, verify=VERIFY_REQUESTS),
             call('http://idm.docker:3000/v1/users/user_id', headers=self._headers, verify=VERIFY_REQUESTS)
         ], get_calls)
 
+    def test_get_organization_members_executor(self):
+        login_response = MagicMock(status_code=201, headers={'x-subject-token': self._x_subject_token})
+
+        members_response = MagicMock(status_code=200)
+        members_response.json.return_value = {
+            'organization_users': [{
+                'user_id': 'user1'
+            }, {
+                'user_id': 'user2'
+            }]
+        }
+
+        def get_response(url, **kwargs):
+            if url.endswith('/users'):
+                return members_response
+
+            user_response = MagicMock(status_code=200)
+            user_response.json.return_value = {
+                'user': {
+                    'username': url.split('/')[-1] + '_name'
+                }
+            }
+            return user_response
+
+        self._session.post.return_value = login_response
+        self._session.get.side_effect = get_response
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            client = keyrock_client.KeyrockClient(self._host, self._user, self._passwd, executor=executor)
+            members = client.get_organization_members('org_id')
+
+        self.assertEqual([{
+            'user_id': 'user1',
+            'name': 'user1_name'
+        }, {
+            'user_id': 'user2',
+            'name': 'user2_name'
+        }], members)
+
     def test_get_users(self):
         login_response = MagicMock(status_code=201, headers={'x-subject-token': self._x_subject_token})
 
@@ -447,19 +559,40 @@ class KeyrockClientTestCase(unittest.TestCase):
         get_users_response = MagicMock(status_code=200)
         get_users_response.json.return_value = users
 
-        keyrock_client.requests.post.return_value = login_response
-        keyrock_client.requests.get.return_value = get_users_response
+        self._session.post.return_value = login_response
+        self._session.get.return_value = get_users_response
 
         client = keyrock_client.KeyrockClient(self._host, self._user, self._passwd)
         resp_users = client.get_users()
 
         self.assertEqual(users, resp_users)
 
+    def test_get_users_cached(self):
+        login_response = MagicMock(status_code=201, headers={'x-subject-token': self._x_subject_token})
+
+        users = {
+            'users': [{
+                'username': 'username'
+            }]
+        }
+        get_users_response = MagicMock(status_code=200)
+        get_users_response.json.return_value = users
+
+        self._session.post.return_value = login_response
+        self._session.get.return_value = get_users_response
+
+        client = keyrock_client.KeyrockClient(self._host, self._user, self._passwd)
+
+        self.assertEqual(users, client.get_users())
+        self.assertEqual(users, client.get_users())
+
+        self._session.get.assert_called_once_with('http://idm.docker:3000/v1/users', headers=self._headers, verify=VERIFY_REQUESTS)
+
     def test_update_organization(self):
         login_response = MagicMock(status_code=201, headers={'x-subject-token': self._x_subject_token})
-        keyrock_client.requests.post.return_value = login_response
+        self._session.post.return_value = login_response
 
-        keyrock_client.requests.patch.return_value = MagicMock(status_code=200)
+        self._session.patch.return_value = MagicMock(status_code=200)
 
         client = keyrock_client.KeyrockClient(self._host, self._user, self._passwd)
         client.update_organization('org_id', {'description': 'New description'})
@@ -469,14 +602,14 @@ class KeyrockClientTestCase(unittest.TestCase):
                 'description': 'New description'
             }
         }
-        keyrock_client.requests.patch.assert_called_once_with(
+        self._session.patch.assert_called_once_with(
             'http://idm.docker:3000/v1/organizations/org_id', headers=self._headers, json=exp_body, verify=VERIFY_REQUESTS)
 
     def test_update_organization_error(self):
         login_response = MagicMock(status_code=201, headers={'x-subject-token': self._x_subject_token})
-        keyrock_client.requests.post.return_value = login_response
+        self._session.post.return_value = login_response
 
-        keyrock_client.requests.patch.return_value = MagicMock(status_code=400)
+        self._session.patch.return_value = MagicMock(status_code=400)
 
         client = keyrock_client.KeyrockClient(self._host, self._user, self._passwd)
 
@@ -489,6 +622,46 @@ class KeyrockClientTestCase(unittest.TestCase):
 
         self.assertTrue(error)
 
+    def test_token_expiry_from_login(self):
+        login_response = MagicMock(status_code=201, headers={'x-subject-token': self._x_subject_token})
+        login_response.json.return_value = {
+            'token': {
+                'methods': ['password'],
+                'expires_at': '2019-05-06T10:00:00.000Z'
+            }
+        }
+        self._session.post.return_value = login_response
+
+        client = keyrock_client.KeyrockClient(self._host, self._user, self._passwd)
+
+        self.assertEqual(1557136800, client._token_expiry)
+
+    def test_token_renewed_when_rejected(self):
+        login_response = MagicMock(status_code=201, headers={'x-subject-token': self._x_subject_token})
+        new_login_response = MagicMock(status_code=201, headers={'x-subject-token': 'new_token'})
+        self._session.post.side_effect = [login_response, new_login_response]
+
+        users = {
+            'users': []
+        }
+        get_users_response = MagicMock(status_code=200)
+        get_users_response.json.return_value = users
+        self._session.get.side_effect = [MagicMock(status_code=401), get_users_response]
+
+        client = keyrock_client.KeyrockClient(self._host, self._user, self._passwd)
+        resp_users = client.get_users()
+
+        self.assertEqual(users, resp_users)
+        self.assertEqual([
+            call('http://idm.docker:3000/v3/auth/tokens', json=self._exp_body, verify=VERIFY_REQUESTS),
+            call('http://idm.docker:3000/v3/auth/tokens', json=self._exp_body, verify=VERIFY_REQUESTS)
+        ], self._session.post.call_args_list)
+
+        self.assertEqual([
+            call('http://idm.docker:3000/v1/users', headers=self._headers, verify=VERIFY_REQUESTS),
+            call('http://idm.docker:3000/v1/users', headers={'X-Auth-Token': 'new_token'}, verify=VERIFY_REQUESTS)
+        ], self._session.get.call_args_list)
+
 
 class UmbrellaClientTestCase(unittest.TestCase):
 
@@ -524,14 +697,15 @@ class UmbrellaClientTestCase(unittest.TestCase):
         get_response = MagicMock(status_code=200)
         get_response.json.side_effect = [apis, changes]
 
-        umbrella_client.requests = MagicMock()
-        umbrella_client.requests.get.return_value = get_response
+        session = MagicMock()
+        umbrella_client.build_session = MagicMock(return_value=session)
+        session.get.return_value = get_response
 
         # Mock put request
-        umbrella_client.requests.put.return_value = MagicMock(status_code=204)
+        session.put.return_value = MagicMock(status_code=204)
 
         # Mock post request
-        umbrella_client.requests.post.return_value = MagicMock(status_code=201)
+        session.post.return_value = MagicMock(status_code=201)
 
         client = umbrella_client.UmbrellaClient(self._host, self._admin_token, self._api_key)
         client.add_sub_url_setting_app_id('2', [{
@@ -575,22 +749,104 @@ class UmbrellaClientTestCase(unittest.TestCase):
         }
 
         # Verify calls
-        get_calls = umbrella_client.requests.get.call_args_list
+        get_calls = session.get.call_args_list
         self.assertEqual([
             call('http://umbrella.docker/api-umbrella/v1/apis.json?start=0&length=100',headers=headers, verify=VERIFY_REQUESTS),
             call('http://umbrella.docker/api-umbrella/v1/config/pending_changes',headers=headers, verify=VERIFY_REQUESTS)
         ], get_calls)
 
-        umbrella_client.requests.put.assert_called_once_with(
+        session.put.assert_called_once_with(
             'http://umbrella.docker/api-umbrella/v1/apis/id',
             headers=headers, json=exp_body, verify=VERIFY_REQUESTS
         )
 
-        umbrella_client.requests.post.assert_called_once_with(
+        session.post.assert_called_once_with(
             'http://umbrella.docker/api-umbrella/v1/config/publish',
             headers=headers, json=exp_changes, verify=VERIFY_REQUESTS
         )
 
+    def test_remove_sub_settings(self):
+        umbrella_client.build_session = MagicMock()
+        client = umbrella_client.UmbrellaClient(self._host, self._admin_token, self._api_key)
+
+        client.get_api_from_app_id = MagicMock(return_value={
+            'id': 'id',
+            'sub_settings': [{'regex': '/a'}, {'regex': '/b'}]
+        })
+
+        def update_api(api_elem):
+            # The update is made while holding the lock of the queued additions
+            self.assertTrue(client._flush_lock.locked())
+
+        client.update_api = MagicMock(side_effect=update_api)
+
+        client.remove_sub_url_settings_app_id('2', lambda setting: setting['regex'] == '/a')
+
+        client.get_api_from_app_id.assert_called_once_with('2')
+        client.update_api.assert_called_once_with({
+            'id': 'id',
+            'sub_settings': [{'regex': '/b'}]
+        })
+
+    def test_queue_sub_settings_batched(self):
+        umbrella_client.build_session = MagicMock()
+        client = umbrella_client.UmbrellaClient(self._host, self._admin_token, self._api_key)
+
+        updates = []
+        threads = []
+
+        def add_sub_settings(app_id, sub_settings):
+            updates.append((app_id, sorted(sub_settings)))
+
+            if len(updates) == 1:
+                # Queue new settings while the first update is in progress
+                for setting in ('b', 'c'):
+                    thread = threading.Thread(
+                        target=client.queue_sub_url_setting_app_id, args=('2', [setting]))
+                    thread.start()
+                    threads.append(thread)
+
+                while len(client._queue) < 2:
+                    time.sleep(0.01)
+
+        client.add_sub_url_setting_app_id = MagicMock(side_effect=add_sub_settings)
+        client.queue_sub_url_setting_app_id('2', ['a'])
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([('2', ['a']), ('2', ['b', 'c'])], updates)
+
+    def test_queue_sub_settings_interrupted(self):
+        umbrella_client.build_session = MagicMock()
+        client = umbrella_client.UmbrellaClient(self._host, self._admin_token, self._api_key)
+
+        class Interrupted(BaseException):
+            pass
+
+        # Settings queued by another caller waiting for the flush lock
+        pending = Future()
+        client._queue.append(('3', ['b'], pending))
+
+        client.add_sub_url_setting_app_id = MagicMock(side_effect=Interrupted())
+
+        with self.assertRaises(Interrupted):
+            client.queue_sub_url_setting_app_id('2', ['a'])
+
+        self.assertTrue(pending.done())
+        self.assertIsInstance(pending.exception(), Interrupted)
+        self.assertEqual(0, len(client._queue))
+
+    def test_queue_sub_settings_error(self):
+        umbrella_client.build_session = MagicMock()
+        client = umbrella_client.UmbrellaClient(self._host, self._admin_token, self._api_key)
+        client.add_sub_url_setting_app_id = MagicMock(side_effect=umbrella_client.UmbrellaError('Error'))
+
+        with self.assertRaises(umbrella_client.UmbrellaError):
+            client.queue_sub_url_setting_app_id('2', ['a'])
+
+        self.assertEqual(0, len(client._queue))
+
 
 @patch("lib.utils.get_content_type", new=MagicMock(return_value="application/json"))
 class ControllerTestCase(unittest.TestCase):
@@ -618,14 +874,15 @@ class ControllerTestCase(unittest.TestCase):
         reload(controller)
 
         # Mock controller dependencies
-        controller.request = MagicMock()
+        controller.request = MagicMock(headers={}, path='/tenant')
 
         self._response = MagicMock()
         controller.make_response = MagicMock(return_value=self._response)
 
         self._keyrock_client = MagicMock()
 
-        controller.KeyrockClient = MagicMock(return_value=self._keyrock_client)
+        utils.KeyrockClient = MagicMock(return_value=self._keyrock_client)
+        utils._keyrock_client = None
 
         self._umbrella_client = MagicMock()
         controller.UmbrellaClient = MagicMock(return_value=self._umbrella_client)
@@ -634,6 +891,7 @@ class ControllerTestCase(unittest.TestCase):
         controller.DatabaseController = MagicMock(return_value=self._database_controller)
 
         controller.build_response = MagicMock(return_value=self._response)
+        controller.build_conditional_response = MagicMock(return_value=self._response)
 
         controller.BROKER_APP_ID = self._broker_app
         controller.BROKER_ADMIN_ROLE = self._admin_role
@@ -657,7 +915,6 @@ class ControllerTestCase(unittest.TestCase):
         }
 
         self._keyrock_client.create_organization.return_value = 'org_id'
-        self._database_controller.get_tenant.return_value = None
 
         response = controller.create(self._user_info)
 
@@ -671,8 +928,9 @@ class ControllerTestCase(unittest.TestCase):
             'org_id', self._broker_app, self._admin_role, self._consumer_role
         )
 
+        # Authorizations are made concurrently so their order is not relevant
         authorize_calls = self._keyrock_client.authorize_organization_role.call_args_list
-        self.assertEqual([
+        self.assertCountEqual([
             call('org_id', self._bae_app, self._bae_seller, 'owner'),
             call('org_id', self._bae_app, self._bae_customer, 'owner'),
             call('org_id', self._bae_app, self._bae_admin, 'owner')
@@ -706,14 +964,15 @@ class ControllerTestCase(unittest.TestCase):
             }
         }]
 
-        self._umbrella_client.add_sub_url_setting_app_id.assert_called_once_with(
+        self._umbrella_client.queue_sub_url_setting_app_id.assert_called_once_with(
             self._broker_app, policy
         )
 
-        self._database_controller.save_tenant.assert_called_once_with(
-            'new_tenant', 'New Tenant', 'tenant description', 'user-id', [], 'org_id', options={
+        self._database_controller.reserve_tenant.assert_called_once_with(
+            'new_tenant', 'New Tenant', 'tenant description', 'user-id', options={
                 'duration': '1D'
             })
+        self._database_controller.complete_tenant.assert_called_once_with('new_tenant', [], 'org_id')
 
     def test_create_tenant_with_users(self):
         # Mock request contents
@@ -733,8 +992,7 @@ class ControllerTestCase(unittest.TestCase):
         }
 
         self._keyrock_client.create_organization.return_value = 'org_id'
-        self._database_controller.get_tenant.return_value = None
-        self._keyrock_client.get_user_id.side_effect = ["username_id", "user2_id"]
+        self._keyrock_client.get_user_id.side_effect = lambda name: name + "_id"
 
         response = controller.create(self._user_info)
 
@@ -749,7 +1007,7 @@ class ControllerTestCase(unittest.TestCase):
         )
 
         authorize_calls = self._keyrock_client.authorize_organization_role.call_args_list
-        self.assertEqual(
+        self.assertCountEqual(
             authorize_calls,
             [
                 call('org_id', self._bae_app, self._bae_seller, 'owner'),
@@ -759,7 +1017,7 @@ class ControllerTestCase(unittest.TestCase):
         )
 
         grant_organization_role_calls = self._keyrock_client.grant_organization_role.call_args_list
-        self.assertEqual(
+        self.assertCountEqual(
             [
                 call('org_id', 'username_id', 'owner'),
                 call('org_id', 'user2_id', 'member')
@@ -794,7 +1052,7 @@ class ControllerTestCase(unittest.TestCase):
             }
         }]
 
-        self._umbrella_client.add_sub_url_setting_app_id.assert_called_once_with(
+        self._umbrella_client.queue_sub_url_setting_app_id.assert_called_once_with(
             self._broker_app, policy
         )
 
@@ -808,8 +1066,9 @@ class ControllerTestCase(unittest.TestCase):
             'roles': [self._consumer_role]
         }]
 
-        self._database_controller.save_tenant.assert_called_once_with(
-            'new_tenant', 'New Tenant', 'tenant description', 'user-id', exp_users, 'org_id', options={})
+        self._database_controller.reserve_tenant.assert_called_once_with(
+            'new_tenant', 'New Tenant', 'tenant description', 'user-id', options={})
+        self._database_controller.complete_tenant.assert_called_once_with('new_tenant', exp_users, 'org_id')
 
     def test_create_tenant_invalid_options(self):
         controller.request.json = {
@@ -904,19 +1163,32 @@ class ControllerTestCase(unittest.TestCase):
         controller.build_response.assert_called_once_with({'error': ANY}, 422)
         controller.DatabaseController.assert_not_called()
 
+    def test_create_tenant_invalid_name_type(self):
+        # Mock request contents
+        controller.request.json = {
+            'name': 1,
+            'description': 'tenant description'
+        }
+
+        response = controller.create(self._user_info)
+
+        self.assertEqual(response, self._response)
+        controller.build_response.assert_called_once_with({'error': 'data.name must be string'}, 422)
+        controller.DatabaseController.assert_not_called()
+
     def test_create_tenant_duplicated_tenant(self):
         # Mock request contents
         controller.request.json = {
             'name': 'New Tenant',
             'description': 'tenant description'
         }
-        self._database_controller.get_tenant.return_value = {}
+        self._database_controller.reserve_tenant.return_value = False
 
         response = controller.create(self._user_info)
 
         self.assertEqual(response, self._response)
         controller.build_response.assert_called_once_with({'error': ANY}, 409)
-        controller.KeyrockClient.assert_not_called()
+        utils.KeyrockClient.assert_not_called()
 
     def test_create_tenant_unexpected_error(self):
         # Mock request contents
@@ -924,10 +1196,10 @@ class ControllerTestCase(unittest.TestCase):
             'name': 'New Tenant',
             'description': 'tenant description'
         }
-        self._database_controller.get_tenant.return_value = None
-        self._database_controller.save_tenant.side_effect = ValueError
+        self._umbrella_client.queue_sub_url_setting_app_id.side_effect = ValueError
 
         self.assertRaises(ValueError, controller.create, self._user_info)
+        self._database_controller.delete_tenant.assert_called_once_with('new_tenant')
 
     def test_create_tenant_error_connecting_keyrock(self):
         # Mock request contents
@@ -935,7 +1207,6 @@ class ControllerTestCase(unittest.TestCase):
             'name': 'New Tenant',
             'description': 'tenant description'
         }
-        self._database_controller.get_tenant.return_value = None
         self._keyrock_client.create_organization.side_effect = keyrock_client.KeyrockError("Error")
 
         response = controller.create(self._user_info)
@@ -943,6 +1214,154 @@ class ControllerTestCase(unittest.TestCase):
         self.assertEqual(response, self._response)
         controller.build_response.assert_called_once_with({'error': 'Error'}, 503)
 
+        # The tenant ID is released
+        self._database_controller.delete_tenant.assert_called_once_with('new_tenant')
+        self._database_controller.complete_tenant.assert_not_called()
+
+    def test_create_tenant_complete_retried(self):
+        controller.request.json = {
+            'name': 'New Tenant',
+            'description': 'tenant description'
+        }
+        controller._COMPLETE_RETRY_DELAY = 0
+        self._keyrock_client.create_organization.return_value = 'org_id'
+        self._database_controller.complete_tenant.side_effect = [PyMongoError('Timeout'), None]
+
+        response = controller.create(self._user_info)
+
+        self.assertEqual(self._response, response)
+        controller.make_response.assert_called_once_with('', 201)
+        self.assertEqual([
+            call('new_tenant', [], 'org_id'),
+            call('new_tenant', [], 'org_id')
+        ], self._database_controller.complete_tenant.call_args_list)
+        self._database_controller.delete_tenant.assert_not_called()
+
+    def test_create_tenant_complete_error(self):
+        controller.request.json = {
+            'name': 'New Tenant',
+            'description': 'tenant description'
+        }
+        controller._COMPLETE_RETRY_DELAY = 0
+        self._keyrock_client.create_organization.return_value = 'org_id'
+        self._database_controller.complete_tenant.side_effect = PyMongoError('Timeout')
+
+        with self.assertRaises(PyMongoError):
+            controller.create(self._user_info)
+
+        self.assertEqual(3, self._database_controller.complete_tenant.call_count)
+        self._database_controller.delete_tenant.assert_not_called()
+
+    def test_create_tenant_async(self):
+        # Mock request contents
+        controller.request.json = {
+            'name': 'New Tenant',
+            'description': 'tenant description'
+        }
+        controller.request.headers = {
+            'Prefer': 'respond-async, wait=10'
+        }
+        controller._job_pool = MagicMock()
+        self._response.headers = {}
+
+        response = controller.create(self._user_info)
+
+        self.assertEqual(self._response, response)
+        controller.build_response.assert_called_once_with({'id': ANY, 'status': 'pending'}, 202)
+        job_id = controller.build_response.call_args[0][0]['id']
+
+        self.assertEqual({
+            'Location': '/tenant/jobs/' + job_id,
+            'Preference-Applied': 'respond-async'
+        }, self._response.headers)
+
+        self._database_controller.save_job.assert_called_once_with(job_id, 'user-id', 'new_tenant')
+        self._database_controller.reserve_tenant.assert_called_once_with(
+            'new_tenant', 'New Tenant', 'tenant description', 'user-id', options={})
+        controller._job_pool.submit.assert_called_once_with(
+            controller._run_tenant_job, job_id, 'new_tenant', 'New Tenant', 'tenant description', [], self._user_info)
+
+        # The tenant is created when the job runs
+        self._keyrock_client.create_organization.assert_not_called()
+
+    def test_create_tenant_async_save_job_error(self):
+        controller.request.json = {
+            'name': 'New Tenant',
+            'description': 'tenant description'
+        }
+        controller.request.headers = {
+            'Prefer': 'respond-async'
+        }
+        controller._job_pool = MagicMock()
+        self._database_controller.save_job.side_effect = PyMongoError('Connection refused')
+
+        with self.assertRaises(PyMongoError):
+            controller.create(self._user_info)
+
+        self._database_controller.delete_tenant.assert_called_once_with('new_tenant')
+        controller._job_pool.submit.assert_not_called()
+
+    def test_run_tenant_job(self):
+        self._keyrock_client.create_organization.return_value = 'org_id'
+        controller._run_tenant_job('job_id', 'new_tenant', 'New Tenant', 'tenant description', [], self._user_info)
+
+        self._database_controller.complete_tenant.assert_called_once_with('new_tenant', [], 'org_id')
+        self._database_controller.update_job.assert_called_once_with('job_id', 'completed')
+
+    def test_run_tenant_job_error(self):
+        self._keyrock_client.create_organization.side_effect = keyrock_client.KeyrockError("Error")
+        controller._run_tenant_job('job_id', 'new_tenant', 'New Tenant', 'tenant description', [], self._user_info)
+
+        self._database_controller.complete_tenant.assert_not_called()
+        self._database_controller.delete_tenant.assert_called_once_with('new_tenant')
+        self._database_controller.update_job.assert_called_once_with('job_id', 'failed', error='Error')
+
+    def test_get_tenant_job(self):
+        job = {
+            'id': 'job_id',
+            'owner_id': 'user-id',
+            'tenant_id': 'new_tenant',
+            'status': 'completed'
+        }
+        self._database_controller.get_job.return_value = job
+
+        response = controller.get_tenant_job(self._user_info, 'job_id')
+
+        self.assertEqual(self._response, response)
+        controller.build_response.assert_called_once_with(job, 200)
+        self._database_controller.get_job.assert_called_once_with('job_id')
+
+    def test_get_tenant_job_not_owner(self):
+        self._database_controller.get_job.return_value = {
+            'id': 'job_id',
+            'owner_id': 'other-id',
+            'tenant_id': 'new_tenant',
+            'status': 'pending'
+        }
+
+        response = controller.get_tenant_job(self._user_info, 'job_id')
+
+        self.assertEqual(self._response, response)
+        controller.build_response.assert_called_once_with({'error': 'Job job_id does not exist'}, 404)
+
+    def test_create_tenant_error_authorizing_organization(self):
+        # Mock request contents
+        controller.request.json = {
+            'name': 'New Tenant',
+            'description': 'tenant description'
+        }
+        self._keyrock_client.create_organization.return_value = 'org_id'
+        self._keyrock_client.authorize_organization_role.side_effect = [
+            None, keyrock_client.KeyrockError("Role error"), None]
+
+        response = controller.create(self._user_info)
+
+        self.assertEqual(response, self._response)
+        controller.build_response.assert_called_once_with({'error': 'Role error'}, 503)
+        self.assertEqual(3, self._keyrock_client.authorize_organization_role.call_count)
+        self._umbrella_client.queue_sub_url_setting_app_id.assert_not_called()
+        self._database_controller.complete_tenant.assert_not_called()
+
     def test_get_tenants(self):
         org_id = 'org_id'
 
@@ -961,9 +1380,18 @@ class ControllerTestCase(unittest.TestCase):
         tenants_response = controller.get(self._user_info)
 
         self.assertEqual(tenants_response, self._response)
-        controller.build_response.assert_called_once_with(tenants, 200)
+        controller.build_conditional_response.assert_called_once_with(tenants, 200)
         self._database_controller.read_tenants.assert_called_once_with('user-id')
 
+    def test_database_controller_reused(self):
+        self._database_controller.read_tenants.return_value = []
+
+        controller.get(self._user_info)
+        controller.get(self._user_info)
+
+        controller.DatabaseController.assert_called_once_with(host=ANY, port=ANY, max_pool_size=ANY)
+        self.assertEqual(2, self._database_controller.read_tenants.call_count)
+
     def test_get_tenants_member(self):
         org_id = 'org_id'
 
@@ -996,7 +1424,7 @@ class ControllerTestCase(unittest.TestCase):
                 'roles': [self._consumer_role, self._admin_role]
             }]
         }]
-        controller.build_response.assert_called_once_with(tenants, 200)
+        controller.build_conditional_response.assert_called_once_with(tenants, 200)
         self._database_controller.read_tenants.assert_called_once_with('user-id')
 
     def test_get_tenant(self):
@@ -1015,7 +1443,8 @@ class ControllerTestCase(unittest.TestCase):
 
         tenant = {
             'tenant_organization': org_id,
-            'owner_id': 'user-id'
+            'owner_id': 'user-id',
+            'users': []
         }
 
         members = [{
@@ -1030,8 +1459,32 @@ class ControllerTestCase(unittest.TestCase):
         tenant_response = controller.get_tenant(self._user_info, tenant_id)
 
         self.assertEqual(tenant_response, self._response)
-        controller.build_response.assert_called_once_with(exp_tenant, 200)
+        controller.build_conditional_response.assert_called_once_with(exp_tenant, 200)
         self._database_controller.get_tenant.assert_called_once_with(tenant_id)
+        self._database_controller.update_tenant.assert_called_once_with(tenant_id, exp_tenant)
+
+    def test_get_tenant_members_unchanged(self):
+        tenant = {
+            'tenant_organization': 'org_id',
+            'owner_id': 'user-id',
+            'users': [{
+                'id': 'user-id',
+                'name': 'username',
+                'roles': [self._consumer_role, self._admin_role]
+            }]
+        }
+
+        self._database_controller.get_tenant.return_value = tenant
+        self._keyrock_client.get_organization_members.return_value = [{
+            'user_id': 'user-id',
+            'name': 'username',
+            'role': 'owner'
+        }]
+
+        controller.get_tenant(self._user_info, 'tenant_id')
+
+        controller.build_conditional_response.assert_called_once_with(tenant, 200)
+        self._database_controller.update_tenant.assert_not_called()
 
     def test_get_tenant_member(self):
         org_id = 'org_id'
@@ -1062,7 +1515,7 @@ class ControllerTestCase(unittest.TestCase):
         tenant_response = controller.get_tenant(self._user_info, tenant_id)
 
         self.assertEqual(tenant_response, self._response)
-        controller.build_response.assert_called_once_with(tenant, 200)
+        controller.build_conditional_response.assert_called_once_with(tenant, 200)
         self._database_controller.get_tenant.assert_called_once_with(tenant_id)
 
     def test_delete_tenant(self):
@@ -1093,7 +1546,12 @@ class ControllerTestCase(unittest.TestCase):
                 }
             }]
         }
-        self._umbrella_client.get_api_from_app_id.return_value = broker_api
+
+        def remove_sub_settings(app_id, is_removed):
+            broker_api['sub_settings'] = [setting for setting in broker_api['sub_settings']
+                                          if not is_removed(setting)]
+
+        self._umbrella_client.remove_sub_url_settings_app_id.side_effect = remove_sub_settings
 
         controller.delete_tenant(self._user_info, tenant_id)
 
@@ -1102,7 +1560,7 @@ class ControllerTestCase(unittest.TestCase):
 
         self._keyrock_client.delete_organization.assert_called_once_with(org_id)
 
-        self._umbrella_client.get_api_from_app_id.assert_called_once_with(self._broker_app)
+        self._umbrella_client.remove_sub_url_settings_app_id.assert_called_once_with(self._broker_app, ANY)
 
         exp_api = {
             'sub_settings': [{
@@ -1114,7 +1572,7 @@ class ControllerTestCase(unittest.TestCase):
                 }
             }]
         }
-        self._umbrella_client.update_api.assert_called_once_with(exp_api)
+        self.assertEqual(exp_api, broker_api)
         self._database_controller.delete_tenant.assert_called_once_with(tenant_id)
 
     def test_get_users(self):
@@ -1141,6 +1599,9 @@ class ControllerTestCase(unittest.TestCase):
         controller.build_response.assert_called_once_with(users, 200)
         self._keyrock_client.get_users.assert_called_once_with()
 
+        self.assertTrue(self._response.cache_control.private)
+        self.assertEqual(5, self._response.cache_control.max_age)
+
     def test_get_users_error_connecting_keyrock(self):
         self._keyrock_client.get_users.side_effect = keyrock_client.KeyrockError("Error")
 
@@ -1513,6 +1974,20 @@ class ControllerTestCase(unittest.TestCase):
 
         self._test_update_error('Conflict applying PATCH, verify indexes and keys', 409)
 
+    def test_debug_flag(self):
+        with patch.dict('os.environ', {'DEBUG': ' True '}):
+            reload(controller)
+
+        self.assertTrue(controller._DEBUG)
+
+    def test_database_error(self):
+        response = controller.database_error(PyMongoError('Connection refused'))
+
+        self.assertEqual(self._response, response)
+        controller.build_response.assert_called_once_with({
+            'error': 'An error occurred accessing the database'
+        }, 503)
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)